@@ -36,7 +36,11 @@ def transfer_tokens(
         )
     except Exception as e:
         logging.error(
-            f"transfer_tokens({sender.public_key_hex}, {recipient.public_key_hex}, {amount}) => {str(e)}"
+            "transfer_tokens(%s, %s, %s) => %s",
+            sender.public_key_hex,
+            recipient.public_key_hex,
+            amount,
+            e,
         )
 
 
@@ -69,14 +73,15 @@ def initialize_erc20_simulation(
         bound_deployer.transfer_clx(agent.public_key_hex, initial_agent_clx_funds)
 
     # Transfer tokens from deployer to agents
-    for agent in agents:
-        bound_deployer.call_contract(
-            abc.transfer(
-                sender_private_key=deployer.private_key,
-                recipient_public_key_hex=agent.public_key_hex,
-                amount=tokens_per_agent,
-            )
+    bound_deployer.call_contracts(
+        abc.transfer(
+            sender_private_key=deployer.private_key,
+            recipient_public_key_hex=agent.public_key_hex,
+            amount=tokens_per_agent,
         )
+        for agent in agents
+    )
+    for agent in agents:
         balance = bound_deployer.query(abc.balance(agent.public_key_hex))
         assert balance == tokens_per_agent
 
@@ -1,12 +1,20 @@
+import functools
 import os
+import threading
+from collections import deque, namedtuple, OrderedDict
 import time
 from pathlib import Path
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import casperlabs_client
 from casperlabs_client.abi import ABI
 
-BASE_PATH = Path(os.path.dirname(os.path.abspath(__file__))).parent.parent.parent.parent
+logger = logging.getLogger(__name__)
+
+BASE_PATH = Path(os.path.abspath(__file__)).parents[4]
+KEYS_PATH = BASE_PATH / "hack" / "docker" / "keys"
 ERC20_WASM = f"{BASE_PATH}/execution-engine/target/wasm32-unknown-unknown/release/erc20_smart_contract.wasm"
 
 
@@ -26,9 +34,62 @@ BALANCE_KEY_SIZE_HEX = "21000000"
 ALLOWANCE_KEY_SIZE_HEX = "40000000"
 BALANCE_BYTE = "01"
 PAYMENT_AMOUNT = 10 ** 7
+# Maximum number of queries sent to a node concurrently.
+MAX_QUERY_THREADS = 32
+# Maximum number of distinct argument combinations per contract method
+# for which the encoded call is kept.
+METHOD_CALL_CACHE_SIZE = 1024
+# Maximum number of contract hashes kept in the cache.
+CONTRACT_HASH_CACHE_SIZE = 256
+
+
+# Hash of a contract stored under a name in a deployer's account,
+# both as raw bytes and in hex.
+ContractHash = namedtuple("ContractHash", ["raw", "hex"])
+
+# (block_hash, deployer, contract_name) => ContractHash, shared by all
+# SmartContract objects. State under a given block hash never changes,
+# so the entries stay valid as long as the block hash is part of the key.
+# Least recently used entries come first.
+_contract_hashes = OrderedDict()
+_contract_hashes_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def _hex_to_bytes(s):
+    # Transfers usually go to a small set of known accounts.
+    return bytes.fromhex(s)
+
+
+def _format_arg(name, value):
+    return f"{name}={value}"
+
+
+def _format_bytes_arg(name, value):
+    return f"{name}={value.hex()}"
+
+
+# (host, port, port_internal) => CasperLabsClient shared by all Nodes
+# connecting to that address.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _client(host, port, port_internal):
+    key = (host, port, port_internal)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = casperlabs_client.CasperLabsClient(
+                host=host, port=port, port_internal=port_internal
+            )
+            _clients[key] = client
+        return client
 
 
 class Node:
+    __slots__ = ("host", "port", "port_internal", "client", "_batch")
+
     def __init__(
         self,
         host,
@@ -38,9 +99,52 @@ class Node:
         self.host = host
         self.port = port
         self.port_internal = port_internal
-        self.client = casperlabs_client.CasperLabsClient(
-            host=self.host, port=port, port_internal=port_internal
-        )
+        self.client = _client(host, port, port_internal)
+        # Per thread state of the current batch: pending is the list of
+        # hashes of deploys to wait for when the batch is flushed,
+        # it is not set when the thread is not in a batch.
+        self._batch = threading.local()
+
+    @contextmanager
+    def batched(self):
+        """
+        Within the with block, calls made by the current thread through
+        agents bound to this node that should wait for their deploys
+        to be processed only record the deploy hashes. All of them are
+        waited for at once when the block is left, see flush.
+        """
+        if getattr(self._batch, "pending", None) is not None:
+            # Nested batch, the outermost one waits for the deploys.
+            yield self
+            return
+        self._batch.pending = []
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._batch.pending = None
+
+    def wait_for_processed(self, deploy_hashes):
+        """
+        Wait for the deploys to be processed or, in a batch, defer
+        the wait until the batch is flushed.
+        """
+        pending = getattr(self._batch, "pending", None)
+        if pending is not None:
+            pending.extend(deploy_hashes)
+        else:
+            wait_for_deploys_processed(self, deploy_hashes)
+
+    def flush(self):
+        """
+        Wait for all deploys recorded so far in the current thread's batch
+        to be processed. Raises exception if execution of any of them failed.
+        """
+        deploy_hashes = getattr(self._batch, "pending", None)
+        if not deploy_hashes:
+            return
+        self._batch.pending = []
+        wait_for_deploys_processed(self, deploy_hashes)
 
 
 class Agent:
@@ -48,9 +152,46 @@ class Agent:
     An account that will be used to call contracts.
     """
 
+    __slots__ = ("name", "private_key", "public_key", "_public_key_hex")
+
     def __init__(self, name):
         self.name = name
-        logging.debug(f"Agent {str(self)}")
+        self._init_key_paths()
+        logger.debug("Agent %s", self)
+
+    def _init_key_paths(self):
+        key_dir = KEYS_PATH / self.name
+        self.private_key = str(key_dir / "account-private.pem")
+        self.public_key = str(key_dir / "account-public.pem")
+        self._public_key_hex = None
+
+    @property
+    def public_key_hex(self):
+        # Read on first use and only once,
+        # the key files do not change while the agent is in use.
+        public_key_hex = getattr(self, "_public_key_hex", None)
+        if public_key_hex is None:
+            path = KEYS_PATH / self.name / "account-id-hex"
+            public_key_hex = self._public_key_hex = path.read_text().strip()
+        return public_key_hex
+
+    def __getattr__(self, attribute):
+        # Only called for attributes that are not set yet.
+        if attribute in ("private_key", "public_key"):
+            # Agent restored without calling __setstate__, for example from
+            # a jsonpickle message that has only the name at the top level.
+            self._init_key_paths()
+            return getattr(self, attribute)
+        raise AttributeError(attribute)
+
+    def __getstate__(self):
+        # Agents are sent to dramatiq workers, which may have the keys
+        # in a different location, so only the name is serialized.
+        return {"name": self.name}
+
+    def __setstate__(self, state):
+        self.name = state["name"]
+        self._init_key_paths()
 
     def __str__(self):
         return f"{self.name}: {self.public_key_hex}"
@@ -61,25 +202,14 @@ class Agent:
         """
         return BoundAgent(self, node)
 
-    @property
-    def private_key(self):
-        return f"{BASE_PATH}/hack/docker/keys/{self.name}/account-private.pem"
-
-    @property
-    def public_key(self):
-        return f"{BASE_PATH}/hack/docker/keys/{self.name}/account-public.pem"
-
-    @property
-    def public_key_hex(self):
-        with open(f"{BASE_PATH}/hack/docker/keys/{self.name}/account-id-hex") as f:
-            return f.read().strip()
-
 
 class BoundAgent:
     """
     An agent that is bound to a node. Can be used to call a contract or issue a query.
     """
 
+    __slots__ = ("agent", "node")
+
     def __init__(self, agent, node):
         self.agent = agent
         self.node = node
@@ -87,9 +217,19 @@ class BoundAgent:
     def call_contract(self, method, wait_for_processed=True):
         deploy_hash = method(self)
         if wait_for_processed:
-            self.wait_for_deploy_processed(deploy_hash)
+            self.node.wait_for_processed([deploy_hash])
         return deploy_hash
 
+    def call_contracts(self, methods, wait_for_processed=True):
+        """
+        Deploy calls of all the given methods first and only then wait
+        for them to be processed, see wait_for_deploys_processed.
+        """
+        deploy_hashes = [method(self) for method in methods]
+        if wait_for_processed:
+            self.node.wait_for_processed(deploy_hashes)
+        return deploy_hashes
+
     def query(self, method):
         return method(self)
 
@@ -102,23 +242,11 @@ class BoundAgent:
             private_key=self.agent.private_key,
         )
         if wait_for_processed:
-            self.wait_for_deploy_processed(deploy_hash)
+            self.node.wait_for_processed([deploy_hash])
         return deploy_hash
 
     def wait_for_deploy_processed(self, deploy_hash, on_error_raise=True):
-        result = None
-        while True:
-            result = self.node.client.showDeploy(deploy_hash)
-            if result.status.state != 1:  # PENDING
-                break
-            # result.status.state == PROCESSED (2)
-            time.sleep(0.1)
-        if on_error_raise:
-            last_processing_result = result.processing_results[0]
-            if last_processing_result.is_error:
-                raise Exception(
-                    f"Deploy {deploy_hash} execution error: {last_processing_result.error_message}"
-                )
+        wait_for_deploys_processed(self.node, [deploy_hash], on_error_raise)
 
 
 class SmartContract:
@@ -126,30 +254,70 @@ class SmartContract:
     Python interface for calling smart contracts.
     """
 
-    def __init__(self, file_name, methods):
+    def __init__(self, file_name, methods, payment_amount=PAYMENT_AMOUNT):
         """
-        :param file_name: Path to WASM file with smart contract.
-        :param methods:   Dictionary mapping contract methods to
-                          their signatures: names and types of
-                          their parameters. See ERC20 for an example.
+        :param file_name:      Path to WASM file with smart contract.
+        :param methods:        Dictionary mapping contract methods to
+                               their signatures: names and types of
+                               their parameters. See ERC20 for an example.
+        :param payment_amount: Amount paid for each call of the contract.
         """
         self.file_name = file_name
         self.methods = methods
+        self.payment_amount = payment_amount
+        # name => function encoding the method's arguments, see abi_encoder
+        self._encoders = {
+            name: self.abi_encoder(name, parameters)
+            for name, parameters in methods.items()
+        }
+        # name => function returned by self.method(name)
+        self._method_cache = {}
+        # Bind contract methods as attributes, except for those that
+        # already exist, for example wrappers like ERC20.deploy.
+        for name in methods:
+            if not hasattr(self, name):
+                setattr(self, name, self.method(name))
 
     def contract_hash_by_name(self, bound_agent, deployer, contract_name, block_hash):
+        cache_key = (block_hash, deployer, contract_name)
+        with _contract_hashes_lock:
+            contract_hash = _contract_hashes.get(cache_key)
+            if contract_hash is not None:
+                _contract_hashes.move_to_end(cache_key)
+                return contract_hash
+
+        # Query outside of the lock, so that lookups can run concurrently.
+        contract_hash = self._query_contract_hash(
+            bound_agent, deployer, contract_name, block_hash
+        )
+        with _contract_hashes_lock:
+            _contract_hashes[cache_key] = contract_hash
+            if len(_contract_hashes) > CONTRACT_HASH_CACHE_SIZE:
+                _contract_hashes.popitem(last=False)
+        return contract_hash
+
+    def _query_contract_hash(self, bound_agent, deployer, contract_name, block_hash):
         response = bound_agent.node.client.queryState(
             block_hash, key=deployer, path=contract_name, keyType="address"
         )
-        return response.key.hash.hash
+        raw = response.key.hash.hash
+        return ContractHash(raw, raw.hex())
+
+    def abi_encoder(self, method_name, parameters):
+        """
+        Returns a function that ABI encodes a dictionary of
+        the method's arguments into session arguments.
 
-    def __getattr__(self, name):
-        return self.method(name)
+        Everything that doesn't depend on values of the arguments
+        is prepared here once per method.
+        """
+        method_arg = ABI.string_value("method", method_name)
+        encoders = tuple(parameters.items())
 
-    def abi_encode_args(self, method_name, parameters, kwargs):
-        args = [ABI.string_value("method", method_name)] + [
-            parameters[p](p, kwargs[p]) for p in parameters
-        ]
-        return ABI.args(args)
+        def encode(kwargs):
+            return ABI.args([method_arg] + [t(p, kwargs[p]) for p, t in encoders])
+
+        return encode
 
     def method(self, name):
         """
@@ -158,40 +326,78 @@ class SmartContract:
         The function returned can be called with keyword arguments matching
         the smart contract's parameters and it will return a function that
         accepts a BoundAgent and actually call the smart contract on a node.
+        Calls with equal hashable arguments of the same types return the
+        same function.
 
         :param name:  name of the smart contract's method
         """
+        callable_method = self._method_cache.get(name)
+        if callable_method is not None:
+            return callable_method
+
         if name not in self.methods:
             raise Exception(f"unknown method {name}")
+        parameters = self.methods[name]
+        names = tuple(parameters)
+        encode = self._encoders[name]
+        expected = frozenset(parameters)
+        formatters = [
+            _format_bytes_arg if parameters[p] == ABI.bytes_value else _format_arg
+            for p in parameters
+        ]
 
-        def callable_method(**kwargs):
-            parameters = self.methods[name]
-            if set(kwargs.keys()) != set(parameters.keys()):
-                raise Exception(
-                    f"Arguments ({kwargs.keys()}) don't match parameters ({parameters.keys()}) of method {name}"
-                )
-            arguments = self.abi_encode_args(name, parameters, kwargs)
-            arguments_string = f"{name}({','.join(f'{p}={type(kwargs[p]) == bytes and kwargs[p].hex() or kwargs[p]}' for p in parameters)})"
+        def deploy_with(*values):
+            kwargs = dict(zip(names, values))
+            arguments = encode(kwargs)
+            # Part of deploy's arguments that is the same for every bound agent.
+            deploy_kwargs_template = {
+                "payment_amount": self.payment_amount,
+                "session_args": arguments,
+            }
 
             def deploy(bound_agent, **session_reference):
-                kwargs = dict(
-                    public_key=bound_agent.agent.public_key,
-                    private_key=bound_agent.agent.private_key,
-                    payment_amount=PAYMENT_AMOUNT,
-                    session_args=arguments,
-                )
+                deploy_kwargs = deploy_kwargs_template.copy()
+                deploy_kwargs["public_key"] = bound_agent.agent.public_key
+                deploy_kwargs["private_key"] = bound_agent.agent.private_key
                 if session_reference:
-                    kwargs.update(session_reference)
+                    deploy_kwargs.update(session_reference)
                 else:
-                    kwargs["session"] = self.file_name
-                logging.debug(f"Call {arguments_string}")
+                    deploy_kwargs["session"] = self.file_name
+                if logger.isEnabledFor(logging.DEBUG):
+                    arguments_string = "%s(%s)" % (
+                        name,
+                        ",".join(f(p, kwargs[p]) for f, p in zip(formatters, names)),
+                    )
+                    logger.debug("Call %s", arguments_string)
                 # TODO: deploy will soon return just the deploy_hash only
-                _, deploy_hash = bound_agent.node.client.deploy(**kwargs)
+                _, deploy_hash = bound_agent.node.client.deploy(**deploy_kwargs)
                 deploy_hash = deploy_hash.hex()
                 return deploy_hash
 
             return deploy
 
+        # Arguments are encoded only once for each combination of their values.
+        # typed=True keeps e.g. 1 and True, which encode differently, apart.
+        cached_deploy_with = functools.lru_cache(
+            maxsize=METHOD_CALL_CACHE_SIZE, typed=True
+        )(deploy_with)
+
+        def callable_method(**kwargs):
+            if kwargs.keys() != expected:
+                raise Exception(
+                    f"Arguments of method {name} don't match its parameters, "
+                    f"missing: {sorted(expected - kwargs.keys())}, "
+                    f"unexpected: {sorted(kwargs.keys() - expected)}"
+                )
+            values = tuple(kwargs[p] for p in names)
+            try:
+                hash(values)
+            except TypeError:
+                # Unhashable values, e.g. bytearray, can't be cached.
+                return deploy_with(*values)
+            return cached_deploy_with(*values)
+
+        self._method_cache[name] = callable_method
         return callable_method
 
 
@@ -200,6 +406,8 @@ class DeployedERC20:
     Interface to an already deployed ERC20 smart contract.
     """
 
+    __slots__ = ("erc20", "token_hash", "proxy_hash", "_balance_key_prefix")
+
     def __init__(self, erc20, token_hash, proxy_hash):
         """
         This constructor is not to be used directly, use
@@ -208,6 +416,9 @@ class DeployedERC20:
         self.erc20 = erc20
         self.token_hash = token_hash
         self.proxy_hash = proxy_hash
+        self._balance_key_prefix = (
+            f"{token_hash.hex}:{BALANCE_KEY_SIZE_HEX}{BALANCE_BYTE}"
+        )
 
     @classmethod
     def create(cls, deployer: BoundAgent, token_name: str):
@@ -217,40 +428,80 @@ class DeployedERC20:
         """
         erc20 = ERC20(token_name)
         block_hash = last_block_hash(deployer.node)
-        return DeployedERC20(
-            erc20,
-            erc20.token_hash(deployer, deployer.agent.public_key_hex, block_hash),
-            erc20.proxy_hash(deployer, deployer.agent.public_key_hex, block_hash),
-        )
+        deployer_public_hex = deployer.agent.public_key_hex
+        # The node has no query for several paths at once,
+        # so run both queries concurrently instead.
+        with ThreadPoolExecutor(2) as executor:
+            token_hash = executor.submit(
+                erc20.token_hash, deployer, deployer_public_hex, block_hash
+            )
+            proxy_hash = executor.submit(
+                erc20.proxy_hash, deployer, deployer_public_hex, block_hash
+            )
+            return DeployedERC20(erc20, token_hash.result(), proxy_hash.result())
 
     def balance(self, account_public_hex):
         """
         Returns function that can be passed a bound agent to return
         the amount of ERC20 tokens deposited in the given account.
         """
+        key = self._balance_key_prefix + account_public_hex
 
         def execute(bound_agent):
-            key = f"{self.token_hash.hex()}:{BALANCE_KEY_SIZE_HEX}{BALANCE_BYTE}{account_public_hex}"
             block_hash_hex = last_block_hash(bound_agent.node)
-            response = bound_agent.node.client.queryState(
-                block_hash_hex, key=key, path="", keyType="local"
-            )
-            return int(response.big_int.value)
+            return self._query_balance(bound_agent, block_hash_hex, key)
+
+        return execute
+
+    def balances(self, account_public_hexes):
+        """
+        Returns function that can be passed a bound agent to return
+        a dictionary mapping each of the given accounts to the amount
+        of ERC20 tokens deposited in it. All balances are read
+        from the same block, the queries are sent concurrently.
+        """
+        prefix = self._balance_key_prefix
+        account_public_hexes = list(account_public_hexes)
+        keys = [prefix + a for a in account_public_hexes]
+
+        def execute(bound_agent):
+            if not keys:
+                return {}
+            block_hash_hex = last_block_hash(bound_agent.node)
+            with ThreadPoolExecutor(min(MAX_QUERY_THREADS, len(keys))) as executor:
+                values = executor.map(
+                    lambda key: self._query_balance(bound_agent, block_hash_hex, key),
+                    keys,
+                )
+                return dict(zip(account_public_hexes, values))
 
         return execute
 
+    def _query_balance(self, bound_agent, block_hash_hex, key):
+        response = bound_agent.node.client.queryState(
+            block_hash_hex, key=key, path="", keyType="local"
+        )
+        return int(response.big_int.value)
+
     def transfer(self, sender_private_key, recipient_public_key_hex, amount):
         """
         Returns a function that can be passed a bound agent and transfer
         given amount of ERC20 tokens from sender to recipient.
         """
 
+        # Arguments don't depend on the bound agent, encode them only once.
+        deploy = self.erc20.method("transfer")(
+            erc20=self.token_hash.raw,
+            recipient=_hex_to_bytes(recipient_public_key_hex),
+            amount=amount,
+        )
+
         def execute(bound_agent):
-            return self.erc20.method("transfer")(
-                erc20=self.token_hash,
-                recipient=bytes.fromhex(recipient_public_key_hex),
-                amount=amount,
-            )(bound_agent, private_key=sender_private_key, session_hash=self.proxy_hash)
+            return deploy(
+                bound_agent,
+                private_key=sender_private_key,
+                session_hash=self.proxy_hash.raw,
+            )
 
         return execute
 
@@ -276,19 +527,27 @@ class ERC20(SmartContract):
         },
     }
 
-    def __init__(self, token_name):
-        super().__init__(ERC20_WASM, ERC20.methods)
+    def __init__(self, token_name, payment_amount=PAYMENT_AMOUNT):
+        super().__init__(ERC20_WASM, ERC20.methods, payment_amount)
         self.token_name = token_name
         self.proxy_name = "erc20_proxy"
 
-    def abi_encode_args(self, method_name, parameters, kwargs):
+    def abi_encoder(self, method_name, parameters):
+        if "erc20" not in parameters:
+            return super().abi_encoder(method_name, parameters)
+
         # When using proxy make sure that token_hash ('erc20') is the first argument
-        args = (
-            [parameters[p](p, kwargs[p]) for p in parameters if p == "erc20"]
-            + [ABI.string_value("method", method_name)]
-            + [parameters[p](p, kwargs[p]) for p in parameters if p != "erc20"]
-        )
-        return ABI.args(args)
+        method_arg = ABI.string_value("method", method_name)
+        erc20_type = parameters["erc20"]
+        encoders = tuple((p, t) for p, t in parameters.items() if p != "erc20")
+
+        def encode(kwargs):
+            return ABI.args(
+                [erc20_type("erc20", kwargs["erc20"]), method_arg]
+                + [t(p, kwargs[p]) for p, t in encoders]
+            )
+
+        return encode
 
     def proxy_hash(self, bound_agent, deployer_public_hex, block_hash):
         return self.contract_hash_by_name(
@@ -310,5 +569,59 @@ class ERC20(SmartContract):
         return execute
 
 
+def wait_for_deploys_processed(node, deploy_hashes, on_error_raise=True):
+    """
+    Wait until all deploys in deploy_hashes are processed.
+
+    Only one deploy is polled at a time. When it gets processed, the other
+    pending deploys included in the same block are resolved with a single
+    showDeploys call instead of being polled one by one. The showDeploys
+    stream is only read until all pending deploys are found, and it is not
+    requested at all when a single deploy is awaited.
+    """
+    # Deploys not known to be processed yet, and the order to poll them in.
+    pending = set(deploy_hashes)
+    poll_order = deque(deploy_hashes)
+    while pending:
+        deploy_hash = poll_order.popleft()
+        if deploy_hash not in pending:
+            # Already found in the block of a deploy polled earlier.
+            continue
+        pending.remove(deploy_hash)
+        while True:
+            result = node.client.showDeploy(deploy_hash)
+            if result.status.state != 1:  # PENDING
+                break
+            # result.status.state == PROCESSED (2)
+            time.sleep(0.1)
+        if not result.processing_results:
+            # Discarded deploys are not included in any block.
+            if on_error_raise:
+                raise Exception(
+                    f"Deploy {deploy_hash} was not processed, state: {result.status.state}"
+                )
+            continue
+        last_processing_result = result.processing_results[0]
+        if on_error_raise and last_processing_result.is_error:
+            raise Exception(
+                f"Deploy {deploy_hash} execution error: {last_processing_result.error_message}"
+            )
+        if not pending:
+            break
+        block_hash = last_processing_result.block_info.summary.block_hash.hex()
+        for processed_deploy in node.client.showDeploys(block_hash):
+            processed_hash = processed_deploy.deploy.deploy_hash.hex()
+            if processed_hash not in pending:
+                continue
+            pending.remove(processed_hash)
+            if on_error_raise and processed_deploy.is_error:
+                raise Exception(
+                    f"Deploy {processed_hash} execution error: {processed_deploy.error_message}"
+                )
+            if not pending:
+                # No need to read the rest of the block's deploys.
+                break
+
+
 def last_block_hash(node):
     return next(node.client.showBlocks(1)).summary.block_hash.hex()
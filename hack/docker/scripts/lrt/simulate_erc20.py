@@ -2,14 +2,14 @@
 
 import random
 import threading
-from erc20 import ERC20, Node, Agent, DeployedERC20, transfer_clx
+from erc20 import ERC20, Node, Agent, DeployedERC20
 
 
 def check_total_token_amount(node, abc, deployer, agents, amount):
-    n = sum(
-        deployer.on(node).call_contract(abc.balance(agent.public_key_hex))
-        for agent in agents + [deployer]
+    balances = deployer.on(node).query(
+        abc.balances([agent.public_key_hex for agent in agents + [deployer]])
     )
+    n = sum(balances.values())
     assert n == amount
 
 
@@ -32,17 +32,19 @@ def initialize_erc20_simulation(
     Transfer tokens_per_agent ERC20 tokens to each agent.
     """
     boss = faucet.on(node)
-    abc = boss.call_contract(
-        ERC20(token_name).deploy(initial_balance=total_token_supply)
-    )
+    boss.call_contract(ERC20(token_name).deploy(initial_balance=total_token_supply))
+    abc = DeployedERC20.create(boss, token_name)
 
-    balance = boss.call_contract(abc.balance(faucet.public_key_hex))
+    balance = boss.query(abc.balance(faucet.public_key_hex))
 
     # Initially deployer's balance should be equal the total token supply
     assert balance == total_token_supply
 
-    for agent in agents:
-        transfer_clx(faucet.on(node), agent.public_key_hex, initial_agent_clx_funds)
+    with node.batched():
+        for agent in agents:
+            boss.transfer_clx(
+                agent.public_key_hex, initial_agent_clx_funds, wait_for_processed=True
+            )
 
     # Transfer tokens from deployer to agents
     for agent in agents:
@@ -53,7 +55,7 @@ def initialize_erc20_simulation(
                 amount=tokens_per_agent,
             )
         )
-        balance = boss.call_contract(abc.balance(agent.public_key_hex))
+        balance = boss.query(abc.balance(agent.public_key_hex))
         assert balance == tokens_per_agent
 
     check_total_token_amount(node, abc, faucet, agents, total_token_supply)
@@ -71,7 +73,7 @@ def transfer_tokens_between_agents(
     """
     Execute transfers between random agents, check total tokens in the system stays the same.
     """
-    abc = DeployedERC20.create(faucet.on(nodes[0]), token_name, True)
+    abc = DeployedERC20.create(faucet.on(nodes[0]), token_name)
     for i in range(number_of_iterations):
         node = random_node(nodes)
         sender, recipient = random.sample(agents, 2)
@@ -98,7 +100,7 @@ def run_agent(
     """
     Transfer random amount of tokens to a random agent, repeat number_of_iterations times.
     """
-    abc = DeployedERC20.create(faucet.on(nodes[0]), token_name, False)
+    abc = DeployedERC20.create(faucet.on(nodes[0]), token_name)
     for i in range(number_of_iterations):
         recipient = random.sample(agents, 1)[0]
         node = random_node(nodes)
@@ -0,0 +1,337 @@
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+from casperlabs_client.abi import ABI
+import erc20
+from erc20 import ERC20, ContractHash, Node, wait_for_deploys_processed
+
+
+# These tests don't need a running node, Node objects talk to StubClient.
+#
+# $ py.test test_erc20_stub.py
+
+PROCESSED = 2
+DISCARDED = 3
+
+
+def deploy_hash(n):
+    return f"{n:02x}" * 32
+
+
+def block_hash(n):
+    return f"b{n:x}" * 32
+
+
+class StubClient:
+    """
+    Stands in for CasperLabsClient. Serves deploys from blocks given as
+    a dictionary mapping block hash to a list of (deploy hash, is_error).
+    Deploys not included in any block are reported as discarded.
+    """
+
+    def __init__(self, blocks=None):
+        self.blocks = blocks or {}
+        self.calls = []
+        # Deploys read so far from showDeploys streams.
+        self.streamed = []
+
+    def showDeploy(self, deploy_hash):
+        self.calls.append(("showDeploy", deploy_hash))
+        for block, deploys in self.blocks.items():
+            for h, is_error in deploys:
+                if h == deploy_hash:
+                    processing_result = SimpleNamespace(
+                        is_error=is_error,
+                        error_message="error",
+                        block_info=SimpleNamespace(
+                            summary=SimpleNamespace(block_hash=bytes.fromhex(block))
+                        ),
+                    )
+                    return SimpleNamespace(
+                        status=SimpleNamespace(state=PROCESSED),
+                        processing_results=[processing_result],
+                    )
+        return SimpleNamespace(
+            status=SimpleNamespace(state=DISCARDED), processing_results=[]
+        )
+
+    def queryState(self, block_hash, key, path, keyType):
+        self.calls.append(("queryState", block_hash, key, path))
+        contract_hash = SimpleNamespace(hash=path.encode())
+        return SimpleNamespace(key=SimpleNamespace(hash=contract_hash))
+
+    def showDeploys(self, block_hash):
+        self.calls.append(("showDeploys", block_hash))
+        for h, is_error in self.blocks[block_hash]:
+            self.streamed.append(h)
+            yield SimpleNamespace(
+                deploy=SimpleNamespace(deploy_hash=bytes.fromhex(h)),
+                is_error=is_error,
+                error_message="error",
+            )
+
+
+@pytest.fixture()
+def client():
+    return StubClient()
+
+
+@pytest.fixture()
+def node(client, monkeypatch):
+    monkeypatch.setattr(erc20, "_client", lambda *args: client)
+    return Node("localhost")
+
+
+def test_deploys_in_one_block_are_checked_with_one_show_deploys(node, client):
+    hashes = [deploy_hash(i) for i in range(3)]
+    client.blocks = {block_hash(1): [(h, False) for h in hashes]}
+
+    wait_for_deploys_processed(node, hashes)
+
+    assert client.calls == [
+        ("showDeploy", hashes[0]),
+        ("showDeploys", block_hash(1)),
+    ]
+
+
+def test_deploys_in_different_blocks_are_polled_per_block(node, client):
+    client.blocks = {
+        block_hash(1): [(deploy_hash(1), False)],
+        block_hash(2): [(deploy_hash(2), False)],
+    }
+
+    wait_for_deploys_processed(node, [deploy_hash(1), deploy_hash(2)])
+
+    assert client.calls == [
+        ("showDeploy", deploy_hash(1)),
+        ("showDeploys", block_hash(1)),
+        ("showDeploy", deploy_hash(2)),
+    ]
+
+
+def test_deploys_found_in_an_earlier_block_are_not_polled(node, client):
+    client.blocks = {
+        block_hash(1): [(deploy_hash(1), False), (deploy_hash(3), False)],
+        block_hash(2): [(deploy_hash(2), False)],
+    }
+
+    wait_for_deploys_processed(node, [deploy_hash(i) for i in (1, 2, 3, 2)])
+
+    assert client.calls == [
+        ("showDeploy", deploy_hash(1)),
+        ("showDeploys", block_hash(1)),
+        ("showDeploy", deploy_hash(2)),
+    ]
+
+
+def test_block_is_read_only_until_all_pending_deploys_are_found(node, client):
+    client.blocks = {block_hash(1): [(deploy_hash(i), False) for i in range(5)]}
+
+    wait_for_deploys_processed(node, [deploy_hash(0), deploy_hash(2)])
+
+    assert client.streamed == [deploy_hash(0), deploy_hash(1), deploy_hash(2)]
+
+
+def test_single_deploy_does_not_need_show_deploys(node, client):
+    client.blocks = {block_hash(1): [(deploy_hash(1), False)]}
+
+    wait_for_deploys_processed(node, [deploy_hash(1)])
+
+    assert client.calls == [("showDeploy", deploy_hash(1))]
+
+
+def test_failed_deploy_in_block_raises(node, client):
+    client.blocks = {block_hash(1): [(deploy_hash(1), False), (deploy_hash(2), True)]}
+
+    with pytest.raises(Exception, match=deploy_hash(2)):
+        wait_for_deploys_processed(node, [deploy_hash(1), deploy_hash(2)])
+
+
+def test_discarded_deploy(node, client):
+    wait_for_deploys_processed(node, [deploy_hash(1)], on_error_raise=False)
+
+    with pytest.raises(Exception, match="not processed"):
+        wait_for_deploys_processed(node, [deploy_hash(1)])
+
+
+def test_batch_waits_for_deploys_when_left(node, client):
+    hashes = [deploy_hash(i) for i in range(3)]
+    client.blocks = {block_hash(1): [(h, False) for h in hashes]}
+
+    with node.batched():
+        node.wait_for_processed(hashes[:1])
+        with node.batched():
+            node.wait_for_processed(hashes[1:])
+        # The nested batch leaves waiting to the outermost one.
+        assert client.calls == []
+
+    assert client.calls == [
+        ("showDeploy", hashes[0]),
+        ("showDeploys", block_hash(1)),
+    ]
+
+
+def test_batch_is_dropped_on_error(node, client):
+    with pytest.raises(ValueError):
+        with node.batched():
+            node.wait_for_processed([deploy_hash(1)])
+            raise ValueError()
+
+    node.flush()
+    assert client.calls == []
+
+
+def test_flush_waits_for_deploys_recorded_so_far(node, client):
+    client.blocks = {block_hash(1): [(deploy_hash(1), False)]}
+
+    with node.batched():
+        node.wait_for_processed([deploy_hash(1)])
+        node.flush()
+        assert client.calls == [("showDeploy", deploy_hash(1))]
+
+    assert client.calls == [("showDeploy", deploy_hash(1))]
+
+
+def test_batch_does_not_affect_other_threads(node, client):
+    client.blocks = {block_hash(1): [(deploy_hash(1), False)]}
+
+    with node.batched():
+        thread = threading.Thread(
+            target=node.wait_for_processed, args=([deploy_hash(1)],)
+        )
+        thread.start()
+        thread.join()
+        assert client.calls == [("showDeploy", deploy_hash(1))]
+
+
+@pytest.fixture()
+def contract_hashes(monkeypatch):
+    monkeypatch.setattr(erc20, "_contract_hashes", OrderedDict())
+    monkeypatch.setattr(erc20, "CONTRACT_HASH_CACHE_SIZE", 2)
+
+
+def queried_blocks(client):
+    return [call[1] for call in client.calls if call[0] == "queryState"]
+
+
+def test_contract_hashes_are_shared_by_erc20_objects(node, client, contract_hashes):
+    bound_agent = SimpleNamespace(node=node)
+
+    token_hash = ERC20("ABC").token_hash(bound_agent, "deployer", "b1")
+    assert ERC20("ABC").token_hash(bound_agent, "deployer", "b1") == token_hash
+    assert token_hash == ContractHash(b"ABC", b"ABC".hex())
+    assert queried_blocks(client) == ["b1"]
+
+
+def test_contract_hash_cache_evicts_least_recently_used(node, client, contract_hashes):
+    bound_agent = SimpleNamespace(node=node)
+    abc = ERC20("ABC")
+
+    for block in ["b1", "b2", "b1", "b3"]:
+        abc.token_hash(bound_agent, "deployer", block)
+    # b2 was used least recently, so adding b3 evicted it.
+    assert queried_blocks(client) == ["b1", "b2", "b3"]
+
+    abc.token_hash(bound_agent, "deployer", "b1")
+    abc.token_hash(bound_agent, "deployer", "b2")
+    assert queried_blocks(client) == ["b1", "b2", "b3", "b2"]
+
+
+def abi_encode_args_reference(method_name, parameters, kwargs):
+    # ERC20.abi_encode_args as it was before per-method encoders.
+    args = (
+        [parameters[p](p, kwargs[p]) for p in parameters if p == "erc20"]
+        + [ABI.string_value("method", method_name)]
+        + [parameters[p](p, kwargs[p]) for p in parameters if p != "erc20"]
+    )
+    return ABI.args(args)
+
+
+ARGUMENT_VALUES = {
+    ABI.bytes_value: bytes(range(32)),
+    ABI.big_int: 1234567,
+    ABI.string_value: "ABC",
+}
+
+
+@pytest.mark.parametrize("method_name", sorted(ERC20.methods))
+def test_abi_encoder_matches_reference_encoding(method_name):
+    parameters = ERC20.methods[method_name]
+    kwargs = {p: ARGUMENT_VALUES[t] for p, t in parameters.items()}
+
+    encode = ERC20("ABC").abi_encoder(method_name, parameters)
+
+    assert encode(kwargs) == abi_encode_args_reference(method_name, parameters, kwargs)
+
+
+@pytest.fixture()
+def keys_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(erc20, "KEYS_PATH", tmp_path)
+    (tmp_path / "account-0").mkdir()
+    (tmp_path / "account-0" / "account-id-hex").write_text("ab" * 32 + "\n")
+    return tmp_path
+
+
+def test_agent_reads_public_key_hex_on_first_use(keys_path):
+    agent = erc20.Agent("account-1")  # no key files, doesn't raise
+    assert agent.private_key == str(keys_path / "account-1" / "account-private.pem")
+
+    assert erc20.Agent("account-0").public_key_hex == "ab" * 32
+
+
+def test_agent_lookup_of_unknown_attribute_does_not_read_keys(keys_path):
+    agent = erc20.Agent("account-1")  # no key files
+
+    assert getattr(agent, "unknown", None) is None
+    assert not hasattr(agent, "unknown")
+    with pytest.raises(FileNotFoundError):
+        agent.public_key_hex
+
+
+def test_agent_is_serialized_by_name(keys_path):
+    jsonpickle = pytest.importorskip("jsonpickle")
+    agent = erc20.Agent("account-0")
+    agent.public_key_hex  # read and keep the key before encoding
+
+    encoded = jsonpickle.encode(agent)
+    assert str(keys_path) not in encoded
+
+    decoded = jsonpickle.decode(encoded)
+    assert decoded.name == "account-0"
+    assert decoded.public_key == agent.public_key
+    assert decoded.public_key_hex == agent.public_key_hex
+
+
+def test_agent_decoded_from_payload_with_name_only(keys_path):
+    jsonpickle = pytest.importorskip("jsonpickle")
+
+    agent = jsonpickle.decode('{"py/object": "erc20.Agent", "name": "account-0"}')
+
+    assert agent.private_key == str(keys_path / "account-0" / "account-private.pem")
+    assert agent.public_key == str(keys_path / "account-0" / "account-public.pem")
+    assert agent.public_key_hex == "ab" * 32
+
+
+@pytest.fixture()
+def store():
+    # Custom ABI type, so values of any type can be passed to the method.
+    contract = erc20.SmartContract(
+        "store.wasm",
+        {"store": {"value": lambda name, value: ABI.string_value(name, str(value))}},
+    )
+    return contract.method("store")
+
+
+def test_method_calls_with_equal_arguments_share_deploy_function(store):
+    assert store(value=1) is store(value=1)
+    # 1 == True, but they are of different types.
+    assert store(value=1) is not store(value=True)
+
+
+def test_method_accepts_unhashable_arguments(store):
+    deploy = store(value=bytearray(b"abc"))
+
+    assert callable(deploy)
+    assert deploy is not store(value=bytearray(b"abc"))